@@ -22,16 +22,30 @@
 from __future__ import unicode_literals
 
 import os
+import copy
+import errno
+import stat
 import json
+import shutil
+import socket
+import struct
+import threading
 
 import argparse
 from argparse import ArgumentParser
-from subprocess import call, check_call
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, call, check_call
 
+import rpm
 import dnf
 import dnf.cli
 from dnf.cli import CliError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 try:
     from dnf.i18n import translation
 except ImportError:
@@ -64,9 +78,21 @@ from distutils.version import StrictVersion
 DNFVERSION = StrictVersion(dnf.const.VERSION)
 
 PLYMOUTH = '/usr/bin/plymouth'
+# plymouthd's control socket (in the abstract namespace) and the request
+# types for the plymouth commands we use - see plymouth's ply-boot-protocol.h
+PLYMOUTH_SOCKET = '\0/org/freedesktop/plymouthd'
+PLYMOUTH_REQUESTS = {
+    '--ping':          b'P',
+    'change-mode':     b'C',
+    'system-update':   b'u',
+    'display-message': b'M',
+    'hide-message':    b'm',
+}
+PLYMOUTH_ACK = b'\x06'
 DEFAULT_DATADIR = '/var/lib/dnf/system-upgrade'
 MAGIC_SYMLINK = '/system-update'
 SYSTEMD_FLAG_FILE = os.path.join(MAGIC_SYMLINK, '.dnf-system-upgrade')
+PREFETCH_THREADS = 4
 
 NO_KERNEL_MSG = _(
     "No new kernel packages were found.")
@@ -117,8 +143,99 @@ def clear_dir(path):
         except OSError:
             pass
 
+def clear_dir_background(path):
+    """Empty path right away, and delete its old contents in the background.
+
+    path is renamed aside and recreated with the same owner, mode and
+    xattrs (e.g. its SELinux label), and a detached 'rm -rf' deletes the
+    old copy (and any leftovers from earlier cleanups that got
+    interrupted). Returns the rm process, or None if we used clear_dir()
+    instead: if path is a symlink (renaming would move the link, not the
+    data behind it) or couldn't be renamed (e.g. it's a mount point)."""
+    path = os.path.normpath(path)
+    parent, name = os.path.split(path)
+    trash = '%s.cleanup-%d' % (path, os.getpid())
+    try:
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            raise OSError(errno.EINVAL, "datadir is a symlink", path)
+        os.rename(path, trash)
+    except OSError:
+        clear_dir(path)
+        return None
+    os.mkdir(path, stat.S_IMODE(st.st_mode))
+    os.chown(path, st.st_uid, st.st_gid)
+    shutil.copystat(trash, path)
+    leftovers = [os.path.join(parent, f) for f in os.listdir(parent)
+                 if f.startswith(name + '.cleanup-')]
+    return Popen(['rm', '-rf', '--'] + leftovers,
+                 close_fds=True, preexec_fn=os.setsid)
+
+# one TransactionSet per prefetch thread, so we only set each one up once
+_prefetch_local = threading.local()
+
+def _prefetch_ts():
+    ts = getattr(_prefetch_local, 'ts', None)
+    if ts is None:
+        ts = rpm.TransactionSet()
+        ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES) # pylint: disable=protected-access
+        # an empty keyring keeps rpm from opening the rpmdb to load gpg keys
+        ts.setKeyring(rpm.keyring())
+        _prefetch_local.ts = ts
+    return ts
+
+def prefetch_rpm(path):
+    """Read the header of the RPM at path so it's already in the page cache
+    when DNF reads it. Errors are ignored; DNF will report them. Returns path."""
+    ts = _prefetch_ts()
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return path
+    try:
+        ts.hdrFromFdno(fd)
+    except rpm.error:
+        pass
+    finally:
+        os.close(fd)
+    return path
+
+def add_rpms(base, datadir):
+    """Add all the RPMs in datadir to the sack of the given base."""
+    rpms = sorted(os.path.join(datadir, f)
+                  for f in os.listdir(datadir) if f.endswith(".rpm"))
+    # DNF's sack isn't thread-safe, so the RPMs still get added one after
+    # another here, but a few threads read the headers ahead of time so
+    # we're not waiting on the disk for each one. With add_remote_rpms()
+    # the whole list is prefetched before DNF reads anything, so the two
+    # don't overlap; with add_remote_rpm() each RPM is added as soon as its
+    # prefetch is done.
+    pool = ThreadPool(PREFETCH_THREADS)
+    try:
+        # DNF 2.0+ can add a whole list at once; older versions take one at a time
+        add_remote_rpms = getattr(base, 'add_remote_rpms', None)
+        if add_remote_rpms is not None:
+            pool.map(prefetch_rpm, rpms)
+            add_remote_rpms(rpms)
+        else:
+            for path in pool.imap(prefetch_rpm, rpms):
+                base.add_remote_rpm(path)
+    finally:
+        pool.terminate()
+    return rpms
+
+def is_kernel(pkg):
+    return pkg.name == 'kernel' or pkg.name.startswith('kernel-')
+
+_RELEASEVER_CACHE = {}
+def detect_releasever(installroot):
+    """Memoized version of dnf.rpm.detect_releasever()"""
+    if installroot not in _RELEASEVER_CACHE:
+        _RELEASEVER_CACHE[installroot] = dnf.rpm.detect_releasever(installroot)
+    return _RELEASEVER_CACHE[installroot]
+
 def checkReleaseVer(conf, target=None):
-    if dnf.rpm.detect_releasever(conf.installroot) == conf.releasever:
+    if detect_releasever(conf.installroot) == conf.releasever:
         raise CliError(RELEASEVER_MSG)
     if target and target != conf.releasever:
         # it's too late to set releasever here, so this can't work.
@@ -136,26 +253,71 @@ def checkDNFVer():
 
 # --- State object - for tracking upgrade state between runs ------------------
 
+# Parsed statefile contents, keyed by (statefile, mtime, size), so that
+# creating a new State doesn't have to re-parse an unchanged file.
+_STATE_CACHE = {}
+
+def _uncache_state(statefile):
+    for key in [k for k in _STATE_CACHE if k[0] == statefile]:
+        del _STATE_CACHE[key]
+
 # DNF-INTEGRATION-NOTE: basically the same thing as dnf.persistor.JSONDB
 class State(object):
     statefile = '/var/lib/dnf/system-upgrade.json'
+    # the items we keep in the statefile; these are plain attributes, and
+    # only get gathered up into a dict when we write the file.
+    _fields = ('download_status', 'datadir',
+               'target_releasever', 'system_releasever',
+               'upgrade_status', 'distro_sync',
+               'allow_erasing', 'best', 'exclude')
+    __slots__ = _fields + ('_dir_ensured', '_dirty')
+
     def __init__(self):
-        self._data = {}
+        self._dir_ensured = False
+        self._dirty = False
         self._read()
 
+    def __setattr__(self, name, value):
+        # note when an item actually changes, so we know if we need to write
+        if name in self._fields and value != getattr(self, name, None):
+            object.__setattr__(self, '_dirty', True)
+        object.__setattr__(self, name, value)
+
     def _read(self):
         try:
-            with open(self.statefile) as fp:
-                self._data = json.load(fp)
-        except IOError:
-            self._data = {}
+            st = os.stat(self.statefile)
+            key = (self.statefile, st.st_mtime, st.st_size)
+            if key not in _STATE_CACHE:
+                with open(self.statefile, 'rb') as fp:
+                    raw = fp.read()
+                _STATE_CACHE[key] = (orjson.loads(raw) if orjson else
+                                     json.loads(raw.decode('utf-8')))
+            data = copy.deepcopy(_STATE_CACHE[key])
+        except (IOError, OSError):
+            data = {}
+        for name in self._fields:
+            setattr(self, name, data.get(name))
+        self._dirty = False
 
     def write(self):
-        dnf.util.ensure_dir(os.path.dirname(self.statefile))
-        with open(self.statefile, 'w') as outf:
-            json.dump(self._data, outf)
+        _uncache_state(self.statefile)
+        if not self._dir_ensured:
+            dnf.util.ensure_dir(os.path.dirname(self.statefile))
+            self._dir_ensured = True
+        data = dict((name, getattr(self, name)) for name in self._fields)
+        raw = orjson.dumps(data) if orjson else json.dumps(data).encode('utf-8')
+        # write to a temporary file and rename it into place, so a crash
+        # can't leave us with a half-written statefile
+        tmpfile = self.statefile + '.tmp'
+        with open(tmpfile, 'wb') as outf:
+            outf.write(raw)
+            outf.flush()
+            os.fsync(outf.fileno())
+        os.rename(tmpfile, self.statefile)
+        self._dirty = False
 
     def clear(self):
+        _uncache_state(self.statefile)
         if os.path.exists(self.statefile):
             os.unlink(self.statefile)
         self._read()
@@ -164,43 +326,61 @@ class State(object):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is None:
+        if exc_type is None and self._dirty:
             self.write()
 
-    # helper function for creating properties. pylint: disable=protected-access
-    def _prop(option): # pylint: disable=no-self-argument
-        def setprop(self, value):
-            self._data[option] = value
-        def getprop(self):
-            return self._data.get(option)
-        return property(getprop, setprop)
-
-    download_status = _prop("download_status")
-    datadir = _prop("datadir")
-    target_releasever = _prop("target_releasever")
-    system_releasever = _prop("system_releasever")
-
-    upgrade_status = _prop("upgrade_status")
-    distro_sync = _prop("distro_sync")
-    allow_erasing = _prop("allow_erasing")
-    best = _prop("best")
-    exclude = _prop("exclude")
-
 # --- Plymouth output helpers -------------------------------------------------
 
 class PlymouthOutput(object):
     """A plymouth output helper class that filters duplicate calls, and stops
-    calling the plymouth binary if we fail to contact it."""
+    calling plymouth if we fail to contact it.
+
+    Requests are sent straight to plymouthd's socket if we can connect to it;
+    otherwise we fall back to running the plymouth binary for each call."""
     def __init__(self):
         self.alive = True
         self._last_args = dict()
         self._last_msg = None
+        self._sock = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(PLYMOUTH_SOCKET)
+        except socket.error:
+            sock.close()
+            return None
+        return sock
+
+    def _request(self, cmd, args):
+        """Build the ply-boot-protocol request equivalent to `plymouth cmd args`"""
+        req = PLYMOUTH_REQUESTS[cmd]
+        if not args:
+            return req + b'\0'
+        # the daemon only wants the value: "--text MSG" -> MSG, "--updates" -> updates
+        arg = args[-1][2:] if cmd == 'change-mode' else args[-1]
+        # the argument length has to fit in one byte (including the NUL)
+        arg = arg.encode('utf-8')[:254].decode('utf-8', 'ignore').encode('utf-8')
+        return req + b'\x02' + struct.pack('B', len(arg) + 1) + arg + b'\0'
+
+    def _send(self, cmd, args):
+        if self._sock is None:
+            self._sock = self._connect()
+        if self._sock is None:
+            return call((PLYMOUTH, cmd) + args) == 0
+        try:
+            self._sock.sendall(self._request(cmd, args))
+            return self._sock.recv(1) == PLYMOUTH_ACK
+        except socket.error:
+            self._sock.close()
+            self._sock = None
+            return False
 
     def _plymouth(self, cmd, *args):
         dupe_cmd = (args == self._last_args.get(cmd))
         if (self.alive and not dupe_cmd) or cmd == '--ping':
             try:
-                self.alive = (call((PLYMOUTH, cmd) + args) == 0)
+                self.alive = self._send(cmd, args)
             except OSError:
                 self.alive = False
             self._last_args[cmd] = args
@@ -229,12 +409,20 @@ class PlymouthTransactionProgress(dnf.callback.TransactionProgress):
     # NOTE: I'm cheating here - this isn't part of the public DNF API
     action = dnf.yum.rpmtrans.LoggingTransactionDisplay().action
 
+    def __init__(self):
+        super(PlymouthTransactionProgress, self).__init__()
+        self._last_percent = -1
+
     # pylint: disable=too-many-arguments
     def progress(self, package, action, ti_done, ti_total, ts_done, ts_total):
         self._update_plymouth(package, action, ts_done, ts_total)
 
     def _update_plymouth(self, package, action, current, total):
-        Plymouth.progress(int(100.0 * current / total))
+        # most events don't change the percentage, so skip those entirely
+        percent = (current * 100) // total
+        if percent != self._last_percent:
+            Plymouth.progress(percent)
+            self._last_percent = percent
         Plymouth.message(self._fmt_event(package, action, current, total))
 
     def _fmt_event(self, package, action, current, total):
@@ -319,7 +507,12 @@ class PluginArgumentParser(ArgumentParser):
             raise CliError(str(e))
 
 ACTIONS = ('download', 'clean', 'reboot', 'upgrade', 'help', 'log')
+# parsers don't keep any state between parse_args() calls, so we only need
+# to build one per prog
+_PARSER_CACHE = {}
 def make_parser(prog):
+    if prog in _PARSER_CACHE:
+        return _PARSER_CACHE[prog]
     p = PluginArgumentParser(prog)
     # show help when passed --help-cmd, like dnf-plugins-core plugins
     p.add_argument('--help-cmd', action='store_true', help=argparse.SUPPRESS)
@@ -364,6 +557,7 @@ def make_parser(prog):
     # hidden option to skip the kernel package check
     p.add_argument('--no-kernel', dest='needkernel', default=True,
                    action='store_false', help=argparse.SUPPRESS)
+    _PARSER_CACHE[prog] = p
     return p
 
 # --- The actual Plugin and Command objects! ----------------------------------
@@ -439,11 +633,23 @@ class SystemUpgradeCommand(dnf.cli.Command):
     def run_transaction(self):
         self._call_sub("transaction")
 
+    # method names for each (phase, action), so we don't have to build them
+    # every time we dispatch
+    _subfuncs = dict(((phase, action), '%s_%s' % (phase, action))
+                     for phase in ('configure', 'check', 'run', 'transaction')
+                     for action in ACTIONS)
+
     def _call_sub(self, name, *args):
-        subfunc = getattr(self, name + '_' + self.opts.action, None)
+        subfunc = getattr(self, self._subfuncs[(name, self.opts.action)], None)
         if callable(subfunc):
             subfunc(*args)
 
+    def _set_pkgdir(self, datadir):
+        # repos.all() gives us a view over every repo, and setting pkgdir on
+        # it sets pkgdir on each of them. This just saves repeating it in
+        # each configure_* step that needs it.
+        self.base.repos.all().pkgdir = datadir
+
     # == configure_*: set up action-specific demands ==========================
 
     def configure_help(self, args):
@@ -454,7 +660,7 @@ class SystemUpgradeCommand(dnf.cli.Command):
         self.cli.demands.resolving = True
         self.cli.demands.available_repos = True
         self.cli.demands.sack_activation = True
-        self.base.repos.all().pkgdir = self.opts.datadir
+        self._set_pkgdir(self.opts.datadir)
         # We want to do the depsolve / download / transaction-test, but *not*
         # run the actual RPM transaction to install the downloaded packages.
         # Setting the "test" flag makes the RPM transaction a test transaction,
@@ -479,7 +685,7 @@ class SystemUpgradeCommand(dnf.cli.Command):
         self.cli.demands.allow_erasing = self.state.allow_erasing
         self.base.conf.best = self.state.best
         self.base.conf.exclude = self.state.exclude
-        self.base.repos.all().pkgdir = self.opts.datadir
+        self._set_pkgdir(self.opts.datadir)
         # don't try to get new metadata, 'cuz we're offline
         self.cli.demands.cacheonly = True
         # and don't ask any questions (we confirmed all this beforehand)
@@ -504,8 +710,7 @@ class SystemUpgradeCommand(dnf.cli.Command):
     def check_reboot(self, basecmd, extargs):
         if not self.state.download_status == 'complete':
             raise CliError(_("system is not ready for upgrade"))
-        if os.path.lexists(MAGIC_SYMLINK):
-            raise CliError(_("upgrade is already scheduled"))
+        # NOTE: run_prepare() checks whether an upgrade is already scheduled
         # FUTURE: checkRPMDBStatus(self.state.download_transaction_id)
         checkDNFVer()
 
@@ -513,7 +718,9 @@ class SystemUpgradeCommand(dnf.cli.Command):
         if not self.state.upgrade_status == 'ready':
             raise CliError( # Translators: do not change "reboot" here
                 _("use '%s reboot' to begin the upgrade") % basecmd)
-        if os.readlink(MAGIC_SYMLINK) != self.state.datadir:
+        # normalize both sides so e.g. a trailing slash doesn't make us bail
+        target = os.path.normpath(os.readlink(MAGIC_SYMLINK))
+        if target != os.path.normpath(self.state.datadir):
             logger.info(_("another upgrade tool is running. exiting quietly."))
             raise SystemExit(0)
         checkDNFVer()
@@ -524,8 +731,13 @@ class SystemUpgradeCommand(dnf.cli.Command):
         self.parser.print_help()
 
     def run_prepare(self, extcmds):
-        # make the magic symlink
-        os.symlink(self.state.datadir, MAGIC_SYMLINK)
+        # make the magic symlink, unless someone else already did
+        try:
+            os.symlink(self.state.datadir, MAGIC_SYMLINK)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise CliError(_("upgrade is already scheduled"))
+            raise
         # write releasever into the flag file so it can be read by systemd
         with open(SYSTEMD_FLAG_FILE, 'w') as flagfile:
             flagfile.write("RELEASEVER=%s\n" % self.state.target_releasever)
@@ -561,7 +773,11 @@ class SystemUpgradeCommand(dnf.cli.Command):
 
     def run_upgrade(self, extcmds):
         # Delete symlink ASAP to avoid reboot loops
-        dnf.yum.misc.unlink_f(MAGIC_SYMLINK)
+        try:
+            os.unlink(MAGIC_SYMLINK)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
         # change the upgrade status (so we can detect crashed upgrades later)
         with self.state as state:
             state.upgrade_status = 'incomplete'
@@ -587,9 +803,7 @@ class SystemUpgradeCommand(dnf.cli.Command):
         # So far, though, the above assumption seems to hold. So... onward!
 
         # add the downloaded RPMs to the sack
-        for f in os.listdir(self.state.datadir):
-            if f.endswith(".rpm"):
-                self.base.add_remote_rpm(os.path.join(self.state.datadir, f))
+        add_rpms(self.base, self.state.datadir)
         # set up the upgrade transaction
         if self.state.distro_sync:
             self.base.distro_sync()
@@ -597,9 +811,16 @@ class SystemUpgradeCommand(dnf.cli.Command):
             self.base.upgrade_all()
 
     def run_clean(self, extcmds):
+        # don't make the user wait for gigabytes of RPMs to be deleted
+        self._clean(background=True)
+
+    def _clean(self, background):
         if self.state.datadir:
             logger.info(_("Cleaning up downloaded data..."))
-            clear_dir(self.state.datadir)
+            if background:
+                clear_dir_background(self.state.datadir)
+            else:
+                clear_dir(self.state.datadir)
         with self.state as state:
             state.download_status = None
             state.upgrade_status = None
@@ -617,10 +838,10 @@ class SystemUpgradeCommand(dnf.cli.Command):
     def transaction_download(self):
         # sanity check: we got a kernel, right?
         pkgs = self.cli.base.transaction.install_set
-        if self.opts.needkernel and not any(p.name.startswith('kernel') for p in pkgs):
+        if self.opts.needkernel and not any(is_kernel(p) for p in pkgs):
             raise CliError(NO_KERNEL_MSG)
         # Okay! Write out the state so the upgrade can use it.
-        system_ver = dnf.rpm.detect_releasever(self.base.conf.installroot)
+        system_ver = detect_releasever(self.base.conf.installroot)
         with self.state as state:
             state.download_status = 'complete'
             state.distro_sync = self.opts.distro_sync
@@ -636,6 +857,7 @@ class SystemUpgradeCommand(dnf.cli.Command):
         Plymouth.message(_("Upgrade complete! Cleaning up and rebooting..."))
         self.log_status(_("Upgrade complete! Cleaning up and rebooting..."),
                         UPGRADE_FINISHED_ID)
-        self.run_clean([])
+        # we're about to reboot, which would kill a background cleanup
+        self._clean(background=False)
         if self.opts.reboot:
             reboot()
@@ -2,6 +2,7 @@
 
 import system_upgrade
 
+import socket
 import unittest
 try:
     from unittest import mock
@@ -15,6 +16,10 @@ from system_upgrade import PLYMOUTH, CliError
 @patch('system_upgrade.call', return_value=0)
 class PlymouthTestCase(unittest.TestCase):
     def setUp(self):
+        # no plymouthd socket, so we use the plymouth binary
+        connect = patch('system_upgrade.PlymouthOutput._connect', return_value=None)
+        connect.start()
+        self.addCleanup(connect.stop)
         self.ply = system_upgrade.PlymouthOutput()
         self.msg = "Hello, plymouth."
         self.msg_args = (PLYMOUTH, "display-message", "--text", self.msg)
@@ -77,6 +82,51 @@ class PlymouthTestCase(unittest.TestCase):
         self.ply.set_mode("updates")
         call.assert_called_once_with((PLYMOUTH, "change-mode", "--updates"))
 
+@patch('system_upgrade.call', return_value=0)
+class PlymouthSocketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sock = mock.MagicMock()
+        self.sock.recv.return_value = system_upgrade.PLYMOUTH_ACK
+        connect = patch('system_upgrade.PlymouthOutput._connect',
+                        return_value=self.sock)
+        connect.start()
+        self.addCleanup(connect.stop)
+        self.ply = system_upgrade.PlymouthOutput()
+
+    def test_ping(self, call):
+        self.assertTrue(self.ply.ping())
+        self.sock.sendall.assert_called_once_with(b'P\0')
+        self.assertFalse(call.called)
+
+    def test_message(self, call):
+        self.ply.message("hi")
+        self.sock.sendall.assert_called_once_with(b'M\x02\x03hi\0')
+        self.assertFalse(call.called)
+
+    def test_long_message(self, call):
+        self.ply.message("x" * 300)
+        request = self.sock.sendall.call_args[0][0]
+        self.assertEqual(request, b'M\x02\xff' + b'x' * 254 + b'\0')
+
+    def test_mode(self, call):
+        self.ply.set_mode("updates")
+        self.sock.sendall.assert_called_once_with(b'C\x02\x08updates\0')
+
+    def test_progress(self, call):
+        self.ply.progress(27)
+        self.sock.sendall.assert_called_once_with(b'u\x02\x0327\0')
+
+    def test_nak(self, call):
+        self.sock.recv.return_value = b'\x15'
+        self.ply.message("hi")
+        self.assertFalse(self.ply.alive)
+
+    def test_socket_error(self, call):
+        self.sock.sendall.side_effect = socket.error
+        self.ply.progress(27)
+        self.assertFalse(self.ply.alive)
+        self.assertTrue(self.sock.close.called)
+
 from dnf.callback import (PKG_CLEANUP, PKG_DOWNGRADE, PKG_INSTALL, PKG_OBSOLETE,
                           PKG_REINSTALL, PKG_REMOVE, PKG_UPGRADE, PKG_VERIFY,
                           TRANS_POST)
@@ -88,6 +138,9 @@ class PlymouthTransactionProgressTestCase(unittest.TestCase):
                TRANS_POST)
     # pylint: disable=protected-access
     def setUp(self):
+        connect = patch('system_upgrade.PlymouthOutput._connect', return_value=None)
+        connect.start()
+        self.addCleanup(connect.stop)
         system_upgrade.Plymouth = system_upgrade.PlymouthOutput()
         self.display = system_upgrade.PlymouthTransactionProgress()
         self.pkg = "testpackage"
@@ -132,6 +185,27 @@ class PlymouthTransactionProgressTestCase(unittest.TestCase):
             mock.call((PLYMOUTH, "display-message", "--text", msg2)),
         ])
 
+    def test_fmt_event(self, call):
+        msg = self.display._fmt_event(self.pkg, PKG_INSTALL, 2, 1000)
+        self.assertEqual(msg, "[2/1000] %s %s..." % (
+            self.display.action[PKG_INSTALL], self.pkg))
+        # unknown actions are shown as-is
+        msg = self.display._fmt_event(self.pkg, "Frobbing", 3, 1000)
+        self.assertEqual(msg, "[3/1000] Frobbing %s..." % self.pkg)
+
+    def test_percent(self, call):
+        with patch('system_upgrade.Plymouth') as ply:
+            for ts_cur, percent in ((1, 0), (333, 33), (999, 99), (1000, 100)):
+                self.display.progress(self.pkg, PKG_INSTALL, 0, 100, ts_cur, 1000)
+                ply.progress.assert_called_with(percent)
+
+    def test_skip_same_percent(self, call):
+        with patch('system_upgrade.Plymouth') as ply:
+            for ts_cur in range(1, 10):
+                self.display.progress(self.pkg, PKG_INSTALL, 0, 100, ts_cur, 1000)
+            ply.progress.assert_called_once_with(0)
+            self.assertEqual(ply.message.call_count, 9)
+
 import os, tempfile, shutil, gettext
 TESTLANG = "zh_CN"
 TESTLANG_MO = "po/%s.mo" % TESTLANG
@@ -259,6 +333,14 @@ class ArgparseTestCase(unittest.TestCase):
             if val:
                 self.assert_error(["download", bad_arg, val], opt)
 
+    def test_parser_cached(self):
+        self.assertIs(system_upgrade.make_parser('system-upgrade'),
+                      system_upgrade.make_parser('system-upgrade'))
+        opts = self.cmd.parse_args(["download", "--releasever=35"])
+        self.assertEqual(opts.releasever, '35')
+        opts = self.cmd.parse_args(["download"])
+        self.assertIs(opts.releasever, None)
+
     def test_actions_exist(self):
         for phase in ('configure', 'run'):
             for action in system_upgrade.ACTIONS:
@@ -298,6 +380,32 @@ class StateTestCase(unittest.TestCase):
         self.state = self.StateClass()
         self.assertIs(self.state.distro_sync, True)
 
+    def test_write_replaces(self):
+        with self.state:
+            self.state.datadir = "/some/path"
+        self.assertFalse(os.path.exists(self.StateClass.statefile + '.tmp'))
+        self.assertEqual(self.StateClass().datadir, "/some/path")
+
+    def test_write_only_changes(self):
+        with self.state:
+            self.state.datadir = "/some/path"
+        with patch.object(self.StateClass, 'write') as write:
+            with self.state:
+                self.state.datadir = "/some/path"
+            with self.StateClass():
+                pass
+            self.assertFalse(write.called)
+            with self.state:
+                self.state.datadir = "/some/other/path"
+            write.assert_called_once_with()
+
+    def test_cached_copy(self):
+        with self.state:
+            self.state.exclude = ["foo"]
+        first, second = self.StateClass(), self.StateClass()
+        first.exclude.append("bar")
+        self.assertEqual(second.exclude, ["foo"])
+
     @classmethod
     def tearDownClass(cls):
         shutil.rmtree(cls.statedir)
@@ -325,6 +433,64 @@ class UtilTestCase(unittest.TestCase):
         self.assertTrue(os.path.isdir(self.tmpdir))
         self.assertEqual(os.listdir(self.tmpdir), [])
 
+    def test_add_rpms(self):
+        for f in ("b.rpm", "a.rpm", "notes.txt"):
+            with open(os.path.join(self.tmpdir, f), 'wt') as fobj:
+                fobj.write("hi there\n")
+        rpms = [os.path.join(self.tmpdir, f) for f in ("a.rpm", "b.rpm")]
+        base = mock.MagicMock()
+        self.assertEqual(system_upgrade.add_rpms(base, self.tmpdir), rpms)
+        base.add_remote_rpms.assert_called_once_with(rpms)
+        self.assertFalse(base.add_remote_rpm.called)
+
+    def test_add_rpms_old_dnf(self):
+        with open(os.path.join(self.tmpdir, "a.rpm"), 'wt') as fobj:
+            fobj.write("hi there\n")
+        base = mock.MagicMock(spec=['add_remote_rpm'])
+        system_upgrade.add_rpms(base, self.tmpdir)
+        base.add_remote_rpm.assert_called_once_with(
+            os.path.join(self.tmpdir, "a.rpm"))
+
+    def test_clear_dir_background(self):
+        os.chmod(self.tmpdir, 0o750)
+        old_st = os.stat(self.tmpdir)
+        leftover = self.tmpdir + '.cleanup-1'
+        os.makedirs(leftover)
+        rm = system_upgrade.clear_dir_background(self.tmpdir)
+        self.assertTrue(os.path.isdir(self.tmpdir))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        st = os.stat(self.tmpdir)
+        self.assertEqual(st.st_mode & 0o777, 0o750)
+        self.assertEqual((st.st_uid, st.st_gid), (old_st.st_uid, old_st.st_gid))
+        self.assertEqual(rm.wait(), 0)
+        self.assertFalse(os.path.exists(leftover))
+        trash = '%s.cleanup-%d' % (self.tmpdir, os.getpid())
+        self.assertFalse(os.path.exists(trash))
+
+    def test_clear_dir_background_symlink(self):
+        target = os.path.join(self.tmpdir, "dir2")
+        link = self.tmpdir + '.link'
+        os.symlink(target, link)
+        self.addCleanup(os.unlink, link)
+        self.assertIs(system_upgrade.clear_dir_background(link), None)
+        self.assertEqual(os.readlink(link), target)
+        self.assertEqual(os.listdir(target), [])
+
+    @patch('system_upgrade.os.rename', side_effect=OSError(16, 'busy'))
+    def test_clear_dir_background_fallback(self, rename):
+        self.assertIs(system_upgrade.clear_dir_background(self.tmpdir), None)
+        self.assertTrue(os.path.isdir(self.tmpdir))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_prefetch_rpm(self):
+        # not a real RPM, and not a file at all: both are left for DNF to report
+        for f in ("file1", "missing.rpm"):
+            path = os.path.join(self.tmpdir, f)
+            self.assertEqual(system_upgrade.prefetch_rpm(path), path)
+
+    def test_prefetch_ts_reused(self):
+        self.assertIs(system_upgrade._prefetch_ts(), system_upgrade._prefetch_ts())
+
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
 
@@ -351,12 +517,23 @@ class CommandTestCase(CommandTestCaseBase):
         # attribute error for non-existent state item
         with self.assertRaises(AttributeError):
             dummy = self.command.state.DOES_NOT_EXIST
+        with self.assertRaises(AttributeError):
+            self.command.state.DOES_NOT_EXIST = True
         # check the context stuff works like we expect
         with self.command.state as state:
             state.datadir = os.path.join(self.statedir, "datadir")
             os.makedirs(state.datadir)
         self.assertTrue(os.path.isdir(self.command.state.datadir))
 
+    def test_call_sub(self):
+        self.command.opts = mock.MagicMock()
+        self.command.opts.action = 'log'
+        with patch('system_upgrade.SystemUpgradeCommand.run_log') as run_log:
+            self.command.run(['log'])
+        run_log.assert_called_once_with(['log'])
+        # there's no check_log(), so this does nothing
+        self.command.doCheck('dnf', ['log'])
+
 class CleanCommandTestCase(CommandTestCaseBase):
     def test_configure_clean(self):
         self.cli.demands.root_user = None
@@ -381,7 +558,10 @@ class CleanCommandTestCase(CommandTestCaseBase):
         self.assertEqual(self.command.state.download_status, "complete")
         self.assertEqual(self.command.state.upgrade_status, "ready")
         # run cleanup
-        self.command.run_clean([])
+        with patch('system_upgrade.Popen') as popen:
+            self.command.run_clean([])
+        trash = '%s.cleanup-%d' % (datadir, os.getpid())
+        self.assertIn(trash, popen.call_args[0][0])
         # datadir remains, but is empty, and state is cleared
         self.assertEqual(datadir, self.command.state.datadir)
         self.assertTrue(os.path.isdir(datadir))
@@ -405,6 +585,19 @@ class CheckDNFVerTestCase(unittest.TestCase):
         with self.assertRaises(CliError):
             system_upgrade.checkDNFVer()
 
+class DetectReleaseverTestCase(unittest.TestCase):
+    def setUp(self):
+        system_upgrade._RELEASEVER_CACHE.clear()
+
+    @patch('dnf.rpm.detect_releasever', return_value='23')
+    def test_cached(self, detect):
+        self.assertEqual(system_upgrade.detect_releasever('/'), '23')
+        self.assertEqual(system_upgrade.detect_releasever('/'), '23')
+        detect.assert_called_once_with('/')
+
+    def tearDown(self):
+        system_upgrade._RELEASEVER_CACHE.clear()
+
 class RebootCheckCommandTestCase(CommandTestCaseBase):
     def setUp(self):
         super(RebootCheckCommandTestCase, self).setUp()
@@ -416,31 +609,36 @@ class RebootCheckCommandTestCase(CommandTestCaseBase):
         self.command.configure_reboot([])
         self.assertTrue(self.cli.demands.root_user)
 
-    def check_reboot(self, status='complete', lexists=False, dnfverok=True):
-        with patch('system_upgrade.os.path.lexists') as lexists_func:
-            with patch('system_upgrade.checkDNFVer') as dnfver_func:
-                self.command.state.download_status = status
-                if dnfverok:
-                    dnfver_func.return_value = None
-                else:
-                    dnfver_func.side_effect = CliError
-                lexists_func.return_value = lexists
-                self.command.check_reboot(None, None)
+    def check_reboot(self, status='complete', dnfverok=True):
+        with patch('system_upgrade.checkDNFVer') as dnfver_func:
+            self.command.state.download_status = status
+            if dnfverok:
+                dnfver_func.return_value = None
+            else:
+                dnfver_func.side_effect = CliError
+            self.command.check_reboot(None, None)
 
     def test_check_reboot_ok(self):
-        self.check_reboot(status='complete', lexists=False, dnfverok=True)
+        self.check_reboot(status='complete', dnfverok=True)
 
     def test_check_reboot_no_download(self):
         with self.assertRaises(CliError):
-            self.check_reboot(status=None, lexists=False, dnfverok=True)
-
-    def test_check_reboot_link_exists(self):
-        with self.assertRaises(CliError):
-            self.check_reboot(status='complete', lexists=True, dnfverok=True)
+            self.check_reboot(status=None, dnfverok=True)
 
     def test_check_reboot_dnfver_bad(self):
         with self.assertRaises(CliError):
-            self.check_reboot(status='complete', lexists=False, dnfverok=False)
+            self.check_reboot(status='complete', dnfverok=False)
+
+    def test_run_prepare_link_exists(self):
+        os.symlink('/some/other/upgrade', self.MAGIC_SYMLINK)
+        self.command.state.datadir = '/lol/wut'
+        with patch('system_upgrade.SYSTEMD_FLAG_FILE', self.SYSTEMD_FLAG_FILE):
+            with patch('system_upgrade.MAGIC_SYMLINK', self.MAGIC_SYMLINK):
+                with self.assertRaises(CliError):
+                    self.command.run_prepare([])
+        self.assertEqual(os.readlink(self.MAGIC_SYMLINK), '/some/other/upgrade')
+        self.assertFalse(os.path.exists(self.SYSTEMD_FLAG_FILE))
+        self.assertIs(self.command.state.upgrade_status, None)
 
     def test_run_prepare(self):
         self.command.state.datadir = '/lol/wut'
@@ -509,6 +707,15 @@ class DownloadCommandTestCase(CommandTestCase):
         with self.assertRaises(CliError):
             self.command.transaction_download()
 
+    def test_is_kernel(self):
+        pkg = mock.MagicMock()
+        for name in ("kernel", "kernel-core", "kernel-rt"):
+            pkg.name = name
+            self.assertTrue(system_upgrade.is_kernel(pkg))
+        for name in ("kernelshark", "libkernel", "bash"):
+            pkg.name = name
+            self.assertFalse(system_upgrade.is_kernel(pkg))
+
 class UpgradeCommandTestCase(CommandTestCase):
     def test_configure_upgrade(self):
         # write state like download would have
@@ -527,6 +734,39 @@ class UpgradeCommandTestCase(CommandTestCase):
         self.assertTrue(self.command.base.conf.assumeyes)
         self.assertTrue(self.cli.demands.cacheonly)
 
+    @patch('system_upgrade.add_rpms')
+    @patch('system_upgrade.Plymouth')
+    @patch('system_upgrade.SystemUpgradeCommand.log_status')
+    def test_run_upgrade(self, log_status, plymouth, add_rpms):
+        symlink = os.path.join(self.statedir, 'symlink')
+        os.symlink(self.statedir, symlink)
+        self.command.state.datadir = self.statedir
+        with patch('system_upgrade.MAGIC_SYMLINK', symlink):
+            self.command.run_upgrade([])
+            self.assertFalse(os.path.lexists(symlink))
+            # already gone? that's fine too.
+            self.command.run_upgrade([])
+        self.assertEqual(self.command.state.upgrade_status, 'incomplete')
+        add_rpms.assert_called_with(self.command.base, self.statedir)
+
+    def check_upgrade(self, link_target, datadir):
+        symlink = os.path.join(self.statedir, 'symlink')
+        os.symlink(link_target, symlink)
+        self.command.state.upgrade_status = 'ready'
+        self.command.state.datadir = datadir
+        with patch('system_upgrade.MAGIC_SYMLINK', symlink):
+            with patch('system_upgrade.checkDNFVer'):
+                self.command.check_upgrade('dnf system-upgrade', [])
+
+    def test_check_upgrade_trailing_slash(self):
+        self.check_upgrade('/var/lib/dnf/system-upgrade/',
+                           '/var/lib/dnf/system-upgrade')
+
+    def test_check_upgrade_other_tool(self):
+        with self.assertRaises(SystemExit):
+            self.check_upgrade('/var/lib/something-else',
+                               '/var/lib/dnf/system-upgrade')
+
 class LogCommandTestCase(CommandTestCase):
     def test_configure_log(self):
         self.command.configure(["log"])